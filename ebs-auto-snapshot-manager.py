@@ -41,7 +41,11 @@ import boto3
 import datetime
 import locale
 import logging
+import threading
 
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 try:
@@ -54,243 +58,341 @@ logging.basicConfig(format='%(asctime)-15s [%(name)s] [%(levelname)s] '
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-ec2 = boto3.client('ec2')
+session = boto3.session.Session()
+session_lock = threading.Lock()
+boto_config = Config(max_pool_connections=50,
+                     retries={'mode': 'adaptive', 'max_attempts': 10},
+                     connect_timeout=3,
+                     read_timeout=30)
 
 default_tag = os.environ.get('custom_tag', 'scheduler:ebs-auto-snapshot-creation')
+expire_tag = 'snapshot:expires'
+max_snapshot_tags = 50
 default_retention_days = int(os.environ.get('default_retention_days', 7))
 custom_aws_regions = os.environ.get('custom_aws_regions', None)
+truthy_values = frozenset({'true', 'yes', '1', 'on'})
+schedule_types = frozenset({'always', 'daily', 'weekly', 'monthly'})
+quiet_copy_errors = frozenset({'ResourceLimitExceeded',
+                               'SnapshotCreationPerVolumeRateExceeded'})
 
-if custom_aws_regions is not None:
-    aws_regions = [region.strip().lower() for region in custom_aws_regions.split(',')]
-else:
-    aws_regions = [region['RegionName'] for region in ec2.describe_regions()['Regions']]
+aws_regions = None
+aws_regions_set = frozenset()
 
 
-def lambda_handler(event=None, context=None):
+@lru_cache(maxsize=None)
+def _ec2_client(region):
+    with session_lock:
+        return session.client('ec2', region_name=region, config=boto_config)
 
-    if context is None:
-        request_id = uuid.uuid4()
-    else:
-        request_id = context.aws_request_id
 
-    today_date = datetime.date.today()
-    today_datetime = datetime.datetime.now().strftime('%Y-%M-%d_%H-%M-%S')
-    today_weekday = datetime.date.strftime(today_date, '%a').lower()
-    today_day = int(datetime.date.strftime(today_date, '%d'))
+def _get_regions():
+    global aws_regions, aws_regions_set
+
+    if aws_regions is None:
+        if custom_aws_regions is not None:
+            regions = [region.strip().lower() for region in custom_aws_regions.split(',')]
+        else:
+            regions = [region['RegionName'] for region in _ec2_client(None).describe_regions()['Regions']]
+
+        aws_regions_set = frozenset(regions)
+        aws_regions = regions
+
+    return aws_regions
 
-    for aws_region in aws_regions:
-
-        log_extra = {'request_id': request_id, 'aws_region': aws_region}
-
-        logger.debug('Entering aws region', extra=log_extra)
-
-        ec2cli = boto3.client('ec2', region_name=aws_region)
-        ec2res = boto3.resource('ec2', region_name=aws_region)
-
-        """
-        Check all volumes with relevant tag and take a snapshot if needed
-        """
-        volumes = ec2cli.describe_volumes(Filters=[{'Name': 'tag-key',
-                                                    'Values': [default_tag]},
-                                                   {'Name':   'status',
-                                                    'Values': ['available',
-                                                               'in-use']},
-                                                   ]
-                                          )['Volumes']
-        for volume in volumes:
-            for tag in volume['Tags']:
-                if tag['Key'] == default_tag:
-                    try:
-                        config = {k.strip().lower(): v.strip().lower() for k, v in
-                                  [option.split('=') for option in tag['Value'].split(';')]}
-                    except ValueError:
-                        config = {'enable': False, 'parse_error': tag['Value']}
-
-            copy_tags = True \
-                if config.get('copytags') in ('true', 'yes') \
-                else False
-            backup_enable = True \
-                if config.get('enable') in ('true', 'yes') \
-                else False
-            schedule_type = config.get('type') \
-                if config.get('type') in ('always', 'daily', 'weekly', 'monthly') \
-                else None
-            retention_days = int(config.get('retention')) \
-                if config.get('retention', '').isdigit() \
-                else default_retention_days
-            when_to_run = config.get('when', '').split(',')
-            destination_copy = config.get('copyto', '').split(',')
-            expire_date = str(today_date + datetime.timedelta(days=retention_days))
-            volume_id = volume['VolumeId']
-
-            if backup_enable:
-
-                if schedule_type == 'always':
-                    description_date = str(today_datetime)
-                else:
-                    description_date = str(today_date)
-
-                if (
-                        (
-                                schedule_type == 'weekly' and today_weekday
-                                not in [when.strip().lower()[:3] for when in when_to_run]
-                        )
-                        or
-                        (
-                                schedule_type == 'monthly' and today_day
-                                not in [int(d) for d in when_to_run
-                                        if d.strip().isdigit() and int(d) in range(1, 32)]
-                        )
-                ):
-                    logger.debug('Skipping volume ({}) snapshot will be '
-                                 'taken ({}) on ({})'.format(volume_id,
-                                                             schedule_type.title(),
-                                                             ','.join(when_to_run).title()),
-                                 extra=log_extra)
-                    continue
 
-                volume_info = ec2res.Volume(volume_id)
-
-                if len(volume_info.attachments) != 0:
-                    instance_id = volume_info.attachments[0]['InstanceId']
-                    instance_device = volume_info.attachments[0]['Device']
-                    instance = ec2res.Instance(instance_id)
-                    for tag in instance.tags:
-                        if tag['Key'] == 'Name':
-                            instance_name = tag['Value']
-                else:
-                    instance_id = '-'
-                    instance_name = '-'
-                    instance_device = '-'
-
-                description = 'Snapshot of [{}] attached to [{}] ' \
-                              '[{}] as [{}] on [{}]'.format(volume_id,
-                                                            instance_id,
-                                                            instance_name,
-                                                            instance_device,
-                                                            description_date)
-
-                snapshots = ec2cli.describe_snapshots(Filters=[{'Name': 'description',
-                                                                'Values': [description]},
-                                                               ])['Snapshots']
-                if len(snapshots) == 0:
-                    snap = volume_info.create_snapshot(Description=description)
-
-                    if copy_tags:
-                        snap.create_tags(Tags=volume['Tags'])
-
-                    new_tag_value = expire_date + ';' + ','.join(destination_copy)
-                    snap.create_tags(Tags=[{'Key': default_tag,
-                                            'Value': new_tag_value}])
-
-                    logger.info('Snapshot for volume ({}) created as '
-                                '({}) to be removed on ({})'.format(volume_id,
-                                                                    snap.snapshot_id,
+def _iter_volumes(ec2cli, filters):
+    for page in ec2cli.get_paginator('describe_volumes').paginate(Filters=filters,
+                                                                  PaginationConfig={'PageSize': 500}):
+        yield from page['Volumes']
+
+
+def _iter_snapshots(ec2cli, filters):
+    for page in ec2cli.get_paginator('describe_snapshots').paginate(OwnerIds=['self'],
+                                                                    Filters=filters,
+                                                                    PaginationConfig={'PageSize': 1000}):
+        yield from page['Snapshots']
+
+
+def _delete_snapshot(aws_region, snapshot_id, expire_date, log_extra):
+    try:
+        _ec2_client(aws_region).delete_snapshot(SnapshotId=snapshot_id)
+        logger.info('Removing snapshot ({}) expired on ({})'.format(snapshot_id,
                                                                     expire_date),
-                                extra=log_extra)
-                else:
-                    logger.info('Snapshot for volume ({}) already taken'.format(volume_id),
-                                extra=log_extra)
+                    extra=log_extra)
+    except ClientError as e:
+        logger.error('Error removing snapshot ({}) expired '
+                     'on ({}): {}'.format(snapshot_id,
+                                          expire_date,
+                                          e.response.get('Error', {}).get('Message', '')),
+                     extra=log_extra)
+
+
+def _copy_snapshot(aws_region, destination, snapshot, expire_date, destination_copy, log_extra):
+    snapshot_id = snapshot['SnapshotId']
+    try:
+        description = snapshot.get('Description', '') \
+                      + ' [Copy of ({}) from ({})]'.format(snapshot_id,
+                                                           aws_region)
+
+        snapshot_target_id = _ec2_client(destination).copy_snapshot(SourceSnapshotId=snapshot_id,
+                                                                    SourceRegion=aws_region,
+                                                                    Description=description)['SnapshotId']
+
+        tag_value = [dest for dest in destination_copy if dest not in aws_regions_set]
+        new_source_tags = [{'Key': default_tag,
+                            'Value': str(expire_date) + ';' + ','.join(tag_value)},
+                           ]
+        target_tags = {tag['Key']: tag['Value'] for tag in snapshot.get('Tags', [])}
+        target_tags[default_tag] = str(expire_date) + ';None'
+        _ec2_client(destination).create_tags(Resources=[snapshot_target_id],
+                                             Tags=[{'Key': key, 'Value': value}
+                                                   for key, value in target_tags.items()])
+        _ec2_client(aws_region).create_tags(Resources=[snapshot_id], Tags=new_source_tags)
+
+        logger.info('Copying snapshot ({}) '
+                    'from ({}) to ({}) as ({})'.format(snapshot_id,
+                                                       aws_region,
+                                                       destination,
+                                                       snapshot_target_id),
+                    extra=log_extra)
+    except ClientError as e:
+        code = e.response.get('Error', {}).get('Code', '')
+        message = e.response.get('Error', {}).get('Message', '')
+        if code in quiet_copy_errors:
+            logger.info('Skipping snapshot ({}): '
+                        '{}'.format(snapshot_id,
+                                    message),
+                        extra=log_extra)
+        else:
+            logger.error("Error copying snapshot ({}) from ({}) "
+                         "to ({}): {}".format(snapshot_id,
+                                              aws_region,
+                                              destination,
+                                              message),
+                         extra=log_extra)
+
+
+def _process_region(aws_region, request_id, today_date, today_datetime, today_weekday, today_day):
+
+    log_extra = {'request_id': request_id, 'aws_region': aws_region}
+
+    logger.debug('Entering aws region', extra=log_extra)
+
+    ec2cli = _ec2_client(aws_region)
+
+    """
+    Check all volumes with relevant tag and take a snapshot if needed
+    """
+    volumes = list(_iter_volumes(ec2cli, [{'Name': 'tag-key',
+                                           'Values': [default_tag]},
+                                          {'Name':   'status',
+                                           'Values': ['available',
+                                                      'in-use']},
+                                          ]))
+
+    instance_ids = list({volume['Attachments'][0]['InstanceId']
+                         for volume in volumes if volume.get('Attachments')})
+    instance_names = {}
+    for i in range(0, len(instance_ids), 200):
+        for page in ec2cli.get_paginator('describe_instances').paginate(
+                Filters=[{'Name': 'instance-id',
+                          'Values': instance_ids[i:i + 200]},
+                         ]):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    instance_names[instance['InstanceId']] = next((tag['Value']
+                                                                   for tag in instance.get('Tags', [])
+                                                                   if tag['Key'] == 'Name'), '-')
+
+    volume_ids = [volume['VolumeId'] for volume in volumes]
+    existing_snapshots = set()
+    for i in range(0, len(volume_ids), 200):
+        existing_snapshots.update((snapshot['VolumeId'], snapshot['Description'])
+                                  for snapshot in _iter_snapshots(ec2cli, [{'Name': 'volume-id',
+                                                                            'Values': volume_ids[i:i + 200]},
+                                                                           ]))
+
+    for volume in volumes:
+        tag_value = next((tag['Value'] for tag in volume.get('Tags', [])
+                          if tag['Key'] == default_tag), None)
+        if tag_value is None:
+            continue
+
+        config = {}
+        for option in tag_value.split(';'):
+            key, separator, value = option.partition('=')
+            if not separator:
+                config = {'enable': False, 'parse_error': tag_value}
+                break
+            config[key.strip().lower()] = value.strip().lower()
+
+        copy_tags = config.get('copytags') in truthy_values
+        backup_enable = config.get('enable') in truthy_values
+        schedule_type = config.get('type')
+        if schedule_type not in schedule_types:
+            schedule_type = None
+        retention = config.get('retention', '')
+        retention_days = int(retention) if retention.isdigit() else default_retention_days
+        when_to_run = config.get('when', '').split(',')
+        destination_copy = config.get('copyto', '').split(',')
+        expire_date = str(today_date + datetime.timedelta(days=retention_days))
+        volume_id = volume['VolumeId']
+
+        if backup_enable:
+
+            if schedule_type == 'always':
+                description_date = str(today_datetime)
             else:
-                if config.get('parse_error', False):
-                    logger.warning('Parser error for volume ({}) [{}]'.format(volume_id,
-                                                                              config.get('parse_error')),
-                                   extra=log_extra)
-                else:
-                    logger.debug('Backup Disabled for volume ({})'.format(volume_id),
-                                 extra=log_extra)
+                description_date = str(today_date)
+
+            weekly_days = {when.strip().lower()[:3] for when in when_to_run}
+            monthly_days = {int(d) for d in when_to_run
+                            if d.strip().isdigit() and 1 <= int(d) <= 31}
+
+            if (
+                    (schedule_type == 'weekly' and today_weekday not in weekly_days)
+                    or
+                    (schedule_type == 'monthly' and today_day not in monthly_days)
+            ):
+                logger.debug('Skipping volume ({}) snapshot will be '
+                             'taken ({}) on ({})'.format(volume_id,
+                                                         schedule_type.title(),
+                                                         ','.join(when_to_run).title()),
+                             extra=log_extra)
+                continue
 
-        """
-        Remove expired snapshots and copy images to the destination region
-        """
-        snapshots = ec2cli.describe_snapshots(Filters=[{'Name': 'tag-key',
-                                                        'Values': [default_tag]},
-                                                       {'Name': 'status',
-                                                        'Values': ['completed']},
-                                                       ])['Snapshots']
-        for snapshot in snapshots:
-            parser_error = False
-            for tag in snapshot['Tags']:
-                if tag['Key'] == default_tag:
-                    try:
-                        expire_date, destination_copy = tag['Value'].split(';')
-                    except ValueError:
-                        parser_error = tag['Value']
-            if parser_error:
-                logger.warning('Parser error for snapshot ({}) [{}]'.format(snapshot['SnapshotId'],
-                                                                            tag['Value']),
+            if volume.get('Attachments'):
+                instance_id = volume['Attachments'][0]['InstanceId']
+                instance_device = volume['Attachments'][0]['Device']
+                instance_name = instance_names.get(instance_id, '-')
+            else:
+                instance_id = '-'
+                instance_name = '-'
+                instance_device = '-'
+
+            description = 'Snapshot of [{}] attached to [{}] ' \
+                          '[{}] as [{}] on [{}]'.format(volume_id,
+                                                        instance_id,
+                                                        instance_name,
+                                                        instance_device,
+                                                        description_date)
+
+            if (volume_id, description) not in existing_snapshots:
+                snapshot_tags = {}
+                if copy_tags:
+                    snapshot_tags.update((tag['Key'], tag['Value']) for tag in volume['Tags'])
+                snapshot_tags[default_tag] = expire_date + ';' + ','.join(destination_copy)
+                if expire_tag in snapshot_tags or len(snapshot_tags) < max_snapshot_tags:
+                    snapshot_tags[expire_tag] = expire_date
+
+                snapshot_id = ec2cli.create_snapshot(
+                    VolumeId=volume_id,
+                    Description=description,
+                    TagSpecifications=[{'ResourceType': 'snapshot',
+                                        'Tags': [{'Key': key, 'Value': value}
+                                                 for key, value in snapshot_tags.items()]},
+                                       ])['SnapshotId']
+
+                logger.info('Snapshot for volume ({}) created as '
+                            '({}) to be removed on ({})'.format(volume_id,
+                                                                snapshot_id,
+                                                                expire_date),
+                            extra=log_extra)
+            else:
+                logger.info('Snapshot for volume ({}) already taken'.format(volume_id),
+                            extra=log_extra)
+        else:
+            if config.get('parse_error', False):
+                logger.warning('Parser error for volume ({}) [{}]'.format(volume_id,
+                                                                          config.get('parse_error')),
                                extra=log_extra)
-                continue
+            else:
+                logger.debug('Backup Disabled for volume ({})'.format(volume_id),
+                             extra=log_extra)
 
-            expire_date = datetime.datetime.strptime(expire_date, '%Y-%m-%d').date()
-            destination_copy = [dest.lower().strip() for dest in destination_copy.split(',')]
+    """
+    Remove expired snapshots and copy images to the destination region
+    """
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        futures = []
+
+        try:
+            for snapshot in _iter_snapshots(ec2cli, [{'Name': 'tag-key',
+                                                      'Values': [default_tag]},
+                                                     {'Name': 'status',
+                                                      'Values': ['completed']},
+                                                     ]):
+                tag_value = next((tag['Value'] for tag in snapshot.get('Tags', [])
+                                  if tag['Key'] == default_tag), None)
+                if tag_value is None:
+                    continue
 
-            if expire_date <= today_date:
                 try:
-                    ec2res.Snapshot(snapshot['SnapshotId']).delete()
-                    logger.info('Removing snapshot ({}) expired on ({})'.format(snapshot['SnapshotId'],
-                                                                                expire_date),
-                                extra=log_extra)
-                except Exception as e:
-                    logger.error('Error removing snapshot ({}) expired '
-                                 'on ({}): {}'.format(snapshot['SnapshotId'],
-                                                      expire_date,
-                                                      e.response['Error']['Message']),
-                                 extra=log_extra)
-            else:
+                    expire_date, destination_copy = tag_value.split(';')
+                    year, month, day = expire_date.split('-')
+                    expire_date = datetime.date(int(year), int(month), int(day))
+                except ValueError:
+                    logger.warning('Parser error for snapshot ({}) [{}]'.format(snapshot['SnapshotId'],
+                                                                                tag_value),
+                                   extra=log_extra)
+                    continue
+
+                destination_copy = [dest.lower().strip() for dest in destination_copy.split(',')]
+
+                if expire_date <= today_date:
+                    futures.append(executor.submit(_delete_snapshot, aws_region, snapshot['SnapshotId'],
+                                                   expire_date, log_extra))
+                    continue
+
                 logger.debug('Keeping snapshot ({}) until ({})'.format(snapshot['SnapshotId'],
                                                                        expire_date),
                              extra=log_extra)
 
-            for destination in destination_copy:
-                if destination in aws_regions:
-                    try:
-                        snapshot_source = boto3.resource('ec2', region_name=aws_region).Snapshot(snapshot['SnapshotId'])
-
-                        description = snapshot_source.description \
-                                      + ' [Copy of ({}) from ({})]'.format(snapshot['SnapshotId'],
-                                                                           aws_region)
-
-                        snapshot_target_id = (
-                            boto3.resource('ec2', region_name=destination)
-                                .Snapshot(snapshot['SnapshotId'])
-                                .copy(Description=description, SourceRegion=aws_region)
-                        )['SnapshotId']
-                        snapshot_target = boto3.resource('ec2', region_name=destination).Snapshot(snapshot_target_id)
-
-                        tag_value = [dest for dest in destination_copy if dest not in aws_regions]
-                        new_source_tags = [{'Key': default_tag,
-                                            'Value': str(expire_date) + ';' + ','.join(tag_value)},
-                                           ]
-                        new_target_tags = [{'Key': default_tag,
-                                            'Value': str(expire_date) + ';None'},
-                                           ]
-                        snapshot_target.create_tags(Tags=snapshot_source.tags)
-                        snapshot_target.create_tags(Tags=new_target_tags)
-                        snapshot_source.create_tags(Tags=new_source_tags)
-
-                        logger.info('Copying snapshot ({}) '
-                                    'from ({}) to ({}) as ({})'.format(snapshot['SnapshotId'],
-                                                                       aws_region,
-                                                                       destination,
-                                                                       snapshot_target_id),
-                                    extra=log_extra)
-                    except Exception as e:
-                        if e.response['Error']['Code'] == 'ResourceLimitExceeded':
-                            logger.info('Skipping snapshot ({}): '
-                                        '{}'.format(snapshot['SnapshotId'],
-                                                    e.response['Error']['Message']),
-                                        extra=log_extra)
-                        else:
-                            logger.error("Error copying snapshot ({}) from ({}) "
-                                         "to ({}): {}".format(snapshot['SnapshotId'],
-                                                              aws_region,
-                                                              destination,
-                                                              e.response['Error']['Message']),
-                                         extra=log_extra)
-                        continue
-
-        logger.debug('Exiting aws region'.format(), extra=log_extra)
+                for destination in destination_copy:
+                    if destination in aws_regions_set:
+                        futures.append(executor.submit(_copy_snapshot, aws_region, destination,
+                                                       snapshot, expire_date,
+                                                       destination_copy, log_extra))
+        finally:
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    logger.error('Error processing snapshot', exc_info=future.exception(),
+                                 extra=log_extra)
+
+    logger.debug('Exiting aws region'.format(), extra=log_extra)
+
+
+def lambda_handler(event=None, context=None):
+
+    if context is None:
+        request_id = uuid.uuid4()
+    else:
+        request_id = context.aws_request_id
+
+    now = datetime.datetime.now()
+    today_date = now.date()
+    today_datetime = '{:%Y-%m-%d_%H-%M-%S}'.format(now)
+    today_weekday = datetime.date.strftime(today_date, '%a').lower()
+    today_day = int(datetime.date.strftime(today_date, '%d'))
+
+    """
+    Regions are independent of each other, process them in parallel
+    """
+    regions = _get_regions()
+
+    with ThreadPoolExecutor(max_workers=min(32, len(regions))) as executor:
+        futures = {executor.submit(_process_region, aws_region, request_id, today_date,
+                                   today_datetime, today_weekday, today_day): aws_region
+                   for aws_region in regions}
+        failed_regions = []
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                failed_regions.append(futures[future])
+                logger.error('Error processing aws region', exc_info=future.exception(),
+                             extra={'request_id': request_id, 'aws_region': futures[future]})
+
+    if failed_regions:
+        raise RuntimeError('Error processing aws regions ({})'.format(','.join(sorted(failed_regions))))
 
 
 if __name__ == '__main__':